@@ -1,12 +1,20 @@
 # This script assumes that you've already created the wireguard server under the "Local" tab in the gui.
 # make a note of the instance number for that server, you'll need it below.
 
-import uuid # UUID Generation
-import shutil # file stuff
+import os # file stuff
+import re # tag searches in the raw config
+import mmap # map the config for splicing
 import ipaddress # IP address math
-import subprocess # launch shell processes
-import xml.etree.ElementTree as ET # xml parser.
-from collections import defaultdict # action menus.
+try:
+    from lxml import etree as ET # xml parser, libxml2 backed.
+    HAS_LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET # fall back to the stdlib parser.
+    HAS_LXML = False
+try:
+    import segno # qr code generator.
+except ImportError:
+    segno = None # fall back to the qrencode package.
 
 # Things you can change:
 default_endpoint = "server.address.com"
@@ -41,13 +49,30 @@ QR_PKG = "https://pkg.freebsd.org/FreeBSD:13:amd64/release_2/All/libqrencode-4.1
 
 # Don't change anything after this.
 
+# wireguard servers and clients in the config. These only run once per run, so
+# compiling them with lxml just saves that one parse of each expression.
+SERVERS_PATH = "./OPNsense/wireguard/server/servers/*"
+CLIENTS_PATH = "./OPNsense/wireguard/client/clients/*"
+if HAS_LXML:
+    SERVERS_XP = ET.XPath(SERVERS_PATH)
+    CLIENTS_XP = ET.XPath(CLIENTS_PATH)
+else:
+    def SERVERS_XP(root):
+        return root.findall(SERVERS_PATH)
+
+    def CLIENTS_XP(root):
+        return root.findall(CLIENTS_PATH)
+
+# uuid attribute of a raw start tag, for matching the spliced server to the tree.
+UUID_ATTRIBUTE = re.compile(rb"""\suuid\s*=\s*(["'])(.*?)\1""")
+
 def main():
     print("OPNsense wireguard config script")
     print("---------------------------------------------------------------------\n\n")
     
     can_qr = False
     
-    if package_prompt:
+    if package_prompt and segno is None:
         print("First off, in order to display a qrcode at the end of the process, ")
         print("we'll need some unsupported packages that I have not vetted fully.")
         print("They've worked fine for me since OPNsense 21.7.x-amd64. Should I install")
@@ -66,30 +91,33 @@ def main():
         
     try:
         print("Reading config.xml...", end='')
-        with open(opnsense_config_xml, "rb") as opnsense_config:
-            config_xml = opnsense_config.read()
-
+        # don't touch the access time while we're at it.
+        config_fd = os.open(opnsense_config_xml, os.O_RDONLY | getattr(os, "O_NOATIME", 0))
+        with os.fdopen(config_fd, "rb") as config_file:
+            # note where the spots we'll edit are before the tree takes up
+            # memory, the edit at the end copies around them.
+            config_stat = os.fstat(config_file.fileno())
+            with mmap.mmap(config_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                clients_span, server_spans = find_elements(data)
+            config_file.seek(0)
+            tree = ET.parse(config_file)
         print("Successful!")
     except FileNotFoundError:
         print("Failed. Can't find the file?")
         exit(-1)
-    except:
-        print("Failed. Unknown issue with config file.")
-        exit(-1)
-
-    try:
-        print("Attempting to parse the config...", end='')
-        tree = ET.ElementTree(ET.fromstring(config_xml))
-    except ParseError:
+    except ET.ParseError:
         print("Failed. Can't parse config file XML")
         exit(-1)
-    except:
-        print("Failed. Unknown issue with parser.")
+    except ValueError as e:
+        print(f"Failed. {e}")
+        exit(-1)
+    except OSError:
+        print("Failed. Unknown issue with config file.")
         exit(-1)
 
     root = tree.getroot()
     print("Getting wireguard instances...", end='')
-    servers = root.findall("./OPNsense/wireguard/server/servers/")
+    servers = SERVERS_XP(root)
     servers_count = len(servers)
     if servers_count == 0:
         print("Could not find any server instances.")
@@ -98,28 +126,32 @@ def main():
     print(f"Found {servers_count}:")
     #servers_count -= 1
 
+    # remember the servers by instance so we don't have to search for the pick.
+    server_by_instance = {}
     for server in servers:
-        name = server.find('name').text
-        instance = server.find('instance').text
+        name = server.findtext('name')
+        instance = server.findtext('instance')
+        server_by_instance.setdefault(instance, server) # first one wins on duplicates.
         print(f"{name}: {instance}")
 
     if user_prompts:
         print("\nWhich instance number do you want to add a client to?")
-        this_instance = input(f"0 to {servers_count}, (blank defaults to ({default_instance})): ") or default_instance
+        this_instance = input(f"{', '.join(server_by_instance)}, (blank defaults to ({default_instance})): ") or default_instance
     else:
         this_instance = default_instance
 
-    if (this_instance is None or # Blank
-            this_instance == "" or # Empty
-            this_instance.lower() != this_instance.upper() or # Non numeric
-            int(this_instance) > servers_count): # too high.
+    try:
+        instance_number = int(this_instance) # also takes care of " 1" and "01".
+    except (TypeError, ValueError): # Blank or non numeric
         user_quit()
 
+    this_instance = str(instance_number)
+
     print(f"You selected {this_instance}. Let me load that server...", end='')
-    server = root.findall("./OPNsense/wireguard/server/servers/*[instance='{0}']".format(this_instance))[0]
+    server = server_by_instance.get(this_instance)
 
     if server is None:
-        print("\nUnable to load instance {this_instance} from config. Sorry.")
+        print(f"\nUnable to load instance {this_instance} from config. Sorry.")
         exit(-1)
 
     print("Got it!")
@@ -130,31 +162,36 @@ def main():
 
     print("Parsing client config for instance...", end='')
     client_count = 0
-    for client in root.findall("./OPNsense/wireguard/client/clients/"): # get clients
+    for client in CLIENTS_XP(root): # get clients
         if client.get("uuid") in server_conf['peers']: # if they're a peer for the server
             client_count += 1
-            try:
-                used_client_ip = ipaddress.ip_network(client.findtext("tunneladdress")).network_address
-                client_conf['net_range'].remove(used_client_ip)
-            except:
-                print("Failed...")
-                exit(-1)
-        
+            used_client_ip = ipaddress.ip_network(client.findtext("tunneladdress")).network_address
+            client_conf['used'].add(int(used_client_ip))
+
+    # and now we can take the first ip nobody is using!
+    safe_ip = next((ip for ip in client_conf['net_range'] if ip not in client_conf['used']), None)
+    if safe_ip is None:
+        print("Failed. There are no free ips left in the server range.")
+        exit(-1)
 
-    # and now we have a clean ip range with no duplicates!
-    safe_ip = str(client_conf['net_range'][0])
-    client_conf['tunneladdress'] = f"{safe_ip}/32"
+    client_conf['tunneladdress'] = f"{ipaddress.ip_address(safe_ip)}/32"
+    import uuid # UUID Generation, imported here so early exits don't pay for it.
     client_conf['uuid'] = str(uuid.uuid4())
     print("Done!")
 
     print("Attempting to generate keys...", end='')
+    import subprocess # launch shell processes, only needed from here on.
     try:
-        client_conf['privkey'] = subprocess.check_output('wg genkey', shell=True, encoding="utf-8").rstrip("\n")
-        client_conf['pubkey'] = subprocess.check_output("echo {0} | wg pubkey".format(client_conf['privkey']), shell=True, encoding="utf-8").rstrip("\n")
-        shared_key = subprocess.check_output('wg genpsk', shell=True, encoding="utf-8").rstrip("\n")
+        # one shell for all three keys, the private key never hits a command line.
+        keys_script = ('priv=$(wg genkey) && '
+                       'pub=$(printf "%s" "$priv" | wg pubkey) && '
+                       'psk=$(wg genpsk) && '
+                       'printf "%s\\n" "$priv" "$pub" "$psk"')
+        keys = subprocess.check_output(["sh", "-c", keys_script], encoding="utf-8")
+        client_conf['privkey'], client_conf['pubkey'], shared_key = keys.splitlines()
         client_conf['psk'] = shared_key
         server_conf['psk'] = shared_key
-    except:
+    except (OSError, subprocess.CalledProcessError, ValueError):
         print("failed!")
         exit(-1)
 
@@ -202,53 +239,59 @@ def main():
             
 
     print("Backing up xml file...", end='')
+    backup_xml = opnsense_config_xml.replace(".xml", ".wgback")
     try:
-        shutil.copy2(opnsense_config_xml, opnsense_config_xml.replace(".xml", ".wgback"))
-    except:
+        # a hard link is enough, the new config gets written to a fresh file.
+        # link to a temp name first so the old backup survives a failed link.
+        backup_temp = backup_xml + ".tmp"
+        if os.path.exists(backup_temp):
+            os.remove(backup_temp)
+        os.link(opnsense_config_xml, backup_temp)
+        replace_file(backup_temp, backup_xml)
+    except OSError:
         print("Unable to backup xml file. Not proceeding!")
         exit(-1)
     print("Backup successful\n")
 
     print("Attempting to edit xml file...", end='')
-    clients_node = root.findall("./OPNsense/wireguard/client/")[0]
-
-    add_formatted_subelement(clients_node, 
-                             "client", 
-                             attrib={
-                                 'uuid':client_conf['uuid']
-                                 }, 
-                             children={
-                                 'enabled':'0',
-                                 'name':client_conf['name'],
-                                 'pubkey':client_conf['pubkey'],
-                                 'psk':client_conf['psk'],
-                                 'tunneladdress':client_conf['tunneladdress'],
-                                 'serveraddress': None,
-                                 'serverport':server_conf['port'],
-                                 'keepalive':'25'
-                                 }, 
-                             indent="  ")
-
-    # add client to server peer list.
-    server_conf['peers'].append(client_conf['uuid'])
-
-    server.find('peers').text = (",".join(server_conf['peers']))
+    children = {
+        'enabled': '0',
+        'name': client_conf['name'],
+        'pubkey': client_conf['pubkey'],
+        'psk': client_conf['psk'],
+        'tunneladdress': client_conf['tunneladdress'],
+        'serveraddress': None,
+        'serverport': server_conf['port'],
+        'keepalive': '25'
+        }
+
+    # the new client, indented relative to the clients node.
+    client_lines = [f'<client uuid="{xml_escape(client_conf["uuid"])}">']
+    for key, value in children.items():
+        if value is None:
+            client_lines.append(f"  <{key}/>")
+        else:
+            client_lines.append(f"  <{key}>{xml_escape(value)}</{key}>")
+    client_lines.append("</client>")
     print("Done...")
 
     print("Attempting to save xml file...", end='')
-    write_succeeded = True
+    # write next to the config and swap it in, so it's never half written.
+    temp_xml = opnsense_config_xml + ".tmp"
     try:
-        tree.write(opnsense_config_xml)
-    except:
-        write_succeeded = False
-
-    if(not write_succeeded):
-        print("Error writing xml file. Restoring backup, just in case...")
-        try:
-            shutil.copy2(opnsense_config_xml.replace(".xml", ".wgback"), opnsense_config_xml)
-        except:
-            print("Can't restore xml. You'll need to fix this yourself. Sorry!")
-            exit(-1)
+        splice_config(opnsense_config_xml, temp_xml, config_stat, clients_span,
+                      server_spans.get(server.get('uuid')), client_lines, client_conf['uuid'])
+        replace_file(temp_xml, opnsense_config_xml)
+    except FileExistsError:
+        print(f"Error writing xml file: {temp_xml} already exists.")
+        print("The original config is untouched. Remove it if nothing else is editing the config.")
+        exit(-1)
+    except (OSError, ValueError) as e:
+        print(f"Error writing xml file: {e}")
+        print("The original config is untouched.")
+        if os.path.exists(temp_xml):
+            os.remove(temp_xml)
+        exit(-1)
 
     print("Done!")
 
@@ -276,8 +319,8 @@ def main():
 
     # Restart
     try:
-        subprocess.run('configctl wireguard restart', shell=True).check_returncode()
-    except subprocess.CalledProcessError:
+        subprocess.run(["configctl", "wireguard", "restart"], check=True)
+    except (OSError, subprocess.CalledProcessError):
         print("No biggie, but you'll need to save and restart wireguard yourself.")
 
     # Sometimes I need to toggle the wireguard instance to make the changes stick.
@@ -287,95 +330,239 @@ def main():
     # to force the changes to apply.
     
     # show qr code
-    if can_qr:       
-        res = subprocess.run(f'qrencode -t png -o {client_png} < {client_filename}', shell=True)
+    if can_qr and segno is not None:
+        # build it straight from the config text, no external tools needed.
+        qr = segno.make(client_text)
+        qr.save(client_png, scale=8)
+        if display_qr:
+            input("Displaying QR code. Maximize your screen and hit enter when ready")
+            qr.terminal(compact=True)
+    elif can_qr:
+        res = subprocess.run(["qrencode", "-t", "png", "-o", client_png], input=client_text, text=True)
         if display_qr:
             input("Displaying QR code. Maximize your screen and hit enter when ready")
-            res = subprocess.run(f'qrencode -t ansiutf8 < {client_filename}', shell=True)
+            res = subprocess.run(["qrencode", "-t", "ansiutf8"], input=client_text, text=True)
         
     print("Done. Now you just need to go into OPNSense, enable the client and hit save!")
     print("There are also .conf (and .png) files for the new client in the root folder. Be sure to secure them.")
 
-def check_package(name, source):
-    print(f"Checking for package {name}...", end='')
-    has_pkg = True # Think positive!
+def installed_packages():
+    # ask pkg for everything once, instead of once per package.
+    import subprocess
     try:
-        p = subprocess.check_output(f"pkg info {name}", shell=True)
-    except subprocess.CalledProcessError:
-        has_pkg = False
+        p = subprocess.run(["pkg", "query", "%n"], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return set()
+
+    return set(p.stdout.split())
 
-    if has_pkg:
+def check_package(name, source, installed):
+    import subprocess
+    print(f"Checking for package {name}...", end='')
+    if name in installed:
         print("found!")
         return True
 
     print("not found!\nAttempting to install...", end='')
     try:
-        p = subprocess.check_output(f"pkg add {source}", shell=True)
+        subprocess.run(["pkg", "add", source], capture_output=True, text=True, check=True)
         print("Successful!")
         return True
 
-    except subprocess.CalledProcessError:
-        print("Failed to install: {p.")
+    except subprocess.CalledProcessError as e:
+        print(f"Failed to install: {e.stderr.strip()}")
+        return False
+    except OSError as e: # no pkg at all
+        print(f"Failed to install: {e}")
         return False
 
 def install_packages():
-    if check_package("png", PNG_PKG) is False:
+    # segno draws the qr code itself, so there's nothing to install.
+    if segno is not None:
+        return True
+
+    installed = installed_packages()
+    if check_package("png", PNG_PKG, installed) is False:
         print("This is a dependency. Will continue without qr code Support.")
         return False
-    if check_package("libqrencode", QR_PKG) is False:
+    if check_package("libqrencode", QR_PKG, installed) is False:
         print("The libqrencode package generates the QR code. Will continue without QR code support.")
         return False
 
     return True
 
-def add_formatted_subelement(root, name, attrib={}, children={}, indent="auto"):
-    # See what the node itself uses for formatting.
-    root_tail = root.tail
-    root_text = root.text
-
-    # attempt to get indentation automatically. Good luck.
-    if indent == "auto":
-        if len(root) > 0: #if there's children this is the best.
-            # get the difference between the text and the tail
-            indent = root[-1].text.replace(root[-1].tail, '')
+def splice_config(config_xml, output_xml, config_stat, clients, server, client_lines, peer, indent="  "):
+    # Copy the config to output_xml with the new client and server peer added.
+    # Only the two spots we change are touched, the rest is copied as is.
+    if clients is None or server is None:
+        raise ValueError("Can't find the wireguard clients or server instance")
+    server, peers = server
+
+    config_fd = os.open(config_xml, os.O_RDONLY | getattr(os, "O_NOATIME", 0))
+    with os.fdopen(config_fd, "rb") as config_file, \
+            mmap.mmap(config_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        # the spans are from when we first read it, so it can't have changed since.
+        current_stat = os.fstat(config_file.fileno())
+        if ((current_stat.st_ino, current_stat.st_size, current_stat.st_mtime_ns) !=
+                (config_stat.st_ino, config_stat.st_size, config_stat.st_mtime_ns)):
+            raise ValueError("config.xml changed while we were running")
+
+        edits = [append_child(data, clients, "clients", client_lines, indent)]
+        if peers is None:
+            edits.append(append_child(data, server, "server", [f"<peers>{peer}</peers>"], indent))
         else:
-            # get the difference between the text and the tail
-            indent = root_text.replace(root_tail, '');
-            # but divide that margin by two because there's no subelements
-            indent = indent[:len(indent)//2]
-    
-    # Now we know our margin, we can also know how deep our element is.
-    # keep in mind that the root element will also unindent on the tail,
-    level = root_tail.count(indent) + 1 # so we'll add another indent to prevent this.
-    element_level = level + 1
-    child_level = level + 2
-
-    # add our element
-    element = ET.SubElement(root, name, attrib)
-
-    # add our children
-    for key, value in children.items():
-        child = ET.SubElement(element, key)
-        child.text = value
-
-    # if there's children
-    if len(element) > 0:
-        element.text = "\n" + (indent * child_level)
-
-        # fix up the padding for the children
-        for sibling in element:
-            sibling.tail = "\n" + (indent * child_level)
-
-        # unindent last sibling
-        element[-1].tail = "\n" + (indent * element_level)
-
-
-    # fix up the padding for the element and its siblings
-    for sibling in root:
-        sibling.tail = "\n" + (indent * element_level)
-
-    # and unindent that last sibling.
-    root[-1].tail = "\n" + (indent * level)
+            edits.append(append_peer(data, peers, peer))
+
+        # create it with the config's mode so the keys are never readable by
+        # more than the config is, and never reuse or follow something already there.
+        output_fd = os.open(output_xml, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                            config_stat.st_mode & 0o7777)
+        with os.fdopen(output_fd, "wb") as output:
+            position = 0
+            for begin, stop, replacement in sorted(edits):
+                copy_range(config_file, output, position, begin)
+                output.write(replacement)
+                position = stop
+            copy_range(config_file, output, position, config_stat.st_size)
+
+            # make sure it's on disk before it gets renamed over the config.
+            output.flush()
+            os.fsync(output.fileno())
+
+def copy_range(source, output, start, stop, chunk_size=1024 * 1024):
+    # Copy source[start:stop] to output a chunk at a time, reading rather than
+    # going through the map keeps the whole config from piling up in memory.
+    source.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        chunk = source.read(min(chunk_size, remaining))
+        if not chunk:
+            raise ValueError("config.xml is shorter than expected")
+        output.write(chunk)
+        remaining -= len(chunk)
+
+def replace_file(source, target):
+    # Rename source over target, then sync the directory so the rename
+    # itself survives a power cut.
+    os.replace(source, target)
+    dir_fd = os.open(os.path.dirname(os.path.abspath(target)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def find_elements(data):
+    # Find the (start, end) of the clients node, and of each server and its
+    # peers by uuid, in the raw config. Plain searches do that in C
+    # instead of a parse calling back into python for every node.
+    # end points at the closing tag, or just past a self closing one.
+    # This runs before the tree is parsed, so it can't lean on it for the layout.
+    wireguard = None
+    start = find_start(data, b"OPNsense", 0, len(data))
+    if start != -1:
+        wireguard = find_span(data, b"wireguard", start, len(data))
+    if wireguard is None:
+        return (None, {})
+
+    # the searches can't tell markup from a commented out tag or CDATA,
+    # so don't guess where we'd splice if there's any in there.
+    for marker in (b"<!--", b"-->", b"<![CDATA[", b"]]>"):
+        if data.find(marker, *wireguard) != -1:
+            raise ValueError("The wireguard section has comments or CDATA in it, "
+                             "so it can't be edited safely.")
+
+    # the client and server sections share their names with the entries
+    # inside them, so we only search past their start tags.
+    clients = None
+    start = find_start(data, b"client", *wireguard)
+    if start != -1:
+        clients = find_span(data, b"clients", start, wireguard[1])
+
+    servers = None
+    start = find_start(data, b"server", *wireguard)
+    if start != -1:
+        servers = find_span(data, b"servers", start, wireguard[1])
+    if servers is None:
+        return (clients, {})
+
+    server_spans = {}
+    position = servers[0]
+    while True:
+        server = find_span(data, b"server", position, servers[1])
+        if server is None:
+            return (clients, server_spans)
+
+        # keyed by uuid so the splice goes into the same server the tree picked.
+        uuid_match = UUID_ATTRIBUTE.search(data, server[0], data.find(b">", *server))
+        if uuid_match is not None:
+            server_uuid = uuid_match.group(2).decode()
+            if server_uuid in server_spans:
+                server_spans[server_uuid] = None # can't tell which one is meant.
+            else:
+                server_spans[server_uuid] = (server, find_span(data, b"peers", *server))
+
+        position = server[1]
+
+def find_start(data, name, begin, end):
+    # Offset of the first <name> start tag in data[begin:end], or -1.
+    match = re.compile(rb"<" + re.escape(name) + rb"[\s/>]").search(data, begin, end)
+    return -1 if match is None else match.start()
+
+def find_span(data, name, begin, end):
+    # (start, end) of the first name element in data[begin:end], or None.
+    # Only good for elements that never contain another of the same name.
+    start = find_start(data, name, begin, end)
+    if start == -1:
+        return None
+
+    tag_end = data.find(b">", start, end)
+    if tag_end == -1:
+        return None
+    if data[tag_end - 1:tag_end] == b"/":
+        return (start, tag_end + 1)
+
+    close = data.find(b"</" + name + b">", tag_end, end)
+    return None if close == -1 else (start, close)
+
+def append_child(data, span, name, lines, indent):
+    # Returns (begin, stop, replacement) that adds lines as the last child
+    # of the element at span, one indent deeper than the element itself.
+    start, end = span
+    line_start = data.rfind(b"\n", 0, start) + 1
+    margin = data[line_start:start].decode()
+    if margin.strip():
+        margin = "" # not on a line of its own, so don't guess.
+
+    child = ("\n" + margin + indent).join(lines)
+
+    if data[end:end + 2] != b"</":
+        # self closing, so open it up.
+        open_tag = data[start:end - 2].decode().rstrip() + ">"
+        return (start, end, f"{open_tag}\n{margin}{indent}{child}\n{margin}</{name}>".encode())
+
+    content_start = data.find(b">", start) + 1
+    if data.find(b"<", content_start, end) == -1:
+        # no children, just whitespace, so replace all of it.
+        return (content_start, end, f"\n{margin}{indent}{child}\n{margin}".encode())
+
+    # the last child's tail already ends with a newline and the margin.
+    return (end, end, f"{indent}{child}\n{margin}".encode())
+
+def append_peer(data, span, peer):
+    # Returns (begin, stop, replacement) that tacks peer on the end of the peers list.
+    start, end = span
+    if data[end:end + 2] != b"</":
+        return (start, end, f"<peers>{peer}</peers>".encode())
+
+    content_start = data.find(b">", start) + 1
+    peers = data[content_start:end].strip()
+    return (content_start, end, (peers + b"," if peers else b"") + peer.encode())
+
+def xml_escape(value):
+    # Escape text for an element or a double quoted attribute. saxutils does
+    # the same, but drags urllib and friends in with it.
+    return (value.replace("&", "&amp;").replace("<", "&lt;")
+            .replace(">", "&gt;").replace('"', "&quot;"))
 
 def parse_actions(selection, actions, default = None):
     return actions.get(selection.lower(), default)
@@ -395,39 +582,40 @@ def parse_server_details(server):
         error_message.append("tunneladdress")
     
     # Parse out ip address.
+    net = None
     try:
         net = ipaddress.ip_network(tunneladdress, strict = False)
-    except:
+    except ValueError:
         error_message.append("available ip range")
-    
-    # get a list of all the valid ips for this range.
-    net_range = list(net.hosts())
-    
-    # and get the netmask.
-    netmask = net.prefixlen
 
-    # remove the netmask
-    tunneladdress = tunneladdress.replace(f"/{netmask}", "")
-    
-    try:
-        # parse the actual ip and remove it from range
-        net_range.remove(ipaddress.ip_address(tunneladdress))
-    except ValueError:
-        pass
-    except:
-        error_message.append("server ip")
+    # the rest needs a network, without one we just report the errors below.
+    if net is not None:
+        # get the range of valid host ips for this network, kept as ints.
+        if net.num_addresses <= 4:
+            # tiny site-to-site nets, let hosts() deal with the /31 and /32 rules.
+            net_range = [int(ip) for ip in net.hosts()]
+        else:
+            # same as hosts(), which keeps the last address for IPv6.
+            net_range = range(int(net.network_address) + 1, int(net.broadcast_address) + (net.version == 6))
+
+        # and get the netmask.
+        netmask = net.prefixlen
+
+        # remove the netmask
+        tunneladdress = tunneladdress.split("/", 1)[0]
+
+        try:
+            # parse the actual ip and mark it as used
+            used = {int(ipaddress.ip_address(tunneladdress))}
+        except ValueError:
+            error_message.append("server ip")
     
     port = server.findtext('port')
     if port is None:
         error_message.append("port")
 
-    peers = server.findtext('peers')
-    if peers is None or peers == "":
-        peers = []
-    elif peers.count(",") == 0:
-        peers = [peers]
-    else:
-        peers = peers.split(",")
+    # split("") gives [''], so drop the empties. Only used for lookups.
+    peers = {peer for peer in (server.findtext('peers') or "").split(",") if peer}
 
     if len(error_message) != 0:
         print("We couldn't parse these fields:")
@@ -443,7 +631,8 @@ def parse_server_details(server):
         }
 
     client_conf = {
-        "net_range": net_range
+        "net_range": net_range,
+        "used": used
         }
 
     return (server_conf, client_conf)